@@ -14,68 +14,117 @@ from sklearn.metrics import confusion_matrix, precision_recall_fscore_support
 matplotlib.use('Agg')
 import os
 from sklearn.metrics import roc_curve, auc, average_precision_score, f1_score, fbeta_score
-from scipy.optimize import brentq
-from scipy.interpolate import interp1d
 import matplotlib.pyplot as plt
 from matplotlib import rc
 import numpy as np
-import pandas as pd
+import torch
 import json
+import threading
+try:
+    from sklearn.metrics import confusion_matrix_at_thresholds
+except ImportError:
+    # scikit-learn < 1.8 only ships the private helper behind roc_curve.
+    from sklearn.metrics._ranking import _binary_clf_curve
+
+    def confusion_matrix_at_thresholds(y_true, y_score):
+        fps, tps, thresholds = _binary_clf_curve(y_true, y_score)
+        return fps[-1] - fps, fps, tps[-1] - tps, tps, thresholds
 rc('font', **{'family': 'serif', 'serif': ['Computer Modern']})
 rc('text', usetex=False)
 
-def evaluate(labels, scores, metric='roc', output_directory="./", epoch=0):
+# ROC figure reused across epochs instead of being rebuilt on every call.
+_ROC_FIG = None
+_ROC_AX = None
+
+# pyplot keeps global state and is not thread-safe. Anything that may draw while
+# the Visualizer's plot worker is busy must hold this lock.
+PYPLOT_LOCK = threading.Lock()
+
+def _to_numpy(labels, scores):
+    """Move labels and scores to the host once as int8 / float32 arrays."""
+    if torch.is_tensor(labels):
+        labels = labels.detach().cpu().numpy()
+    if torch.is_tensor(scores):
+        scores = scores.detach().cpu().numpy()
+    labels = np.asarray(labels).astype(np.int8, copy=False)
+    scores = np.asarray(scores).astype(np.float32, copy=False)
+    return labels, scores
+
+def _fast_roc(labels, scores):
+    """ROC curve from one sorted pass of confusion_matrix_at_thresholds.
+
+    Collinear intermediate points are dropped exactly as roc_curve's default
+    drop_intermediate=True does, so thresholds match get_performance().
+
+    Returns:
+        fpr, tpr, thresholds: Same as sklearn.metrics.roc_curve.
+    """
+    _, fps, _, tps, thresholds = confusion_matrix_at_thresholds(labels, scores)
+    if fps.size > 2:
+        # Keep only corners: points where the "second derivative" of fps or tps is non-zero.
+        corners = np.concatenate(([True], np.logical_or(np.diff(fps, 2), np.diff(tps, 2)), [True]))
+        fps, tps, thresholds = fps[corners], tps[corners], thresholds[corners]
+    fpr = np.concatenate(([0.], fps / fps[-1]))
+    tpr = np.concatenate(([0.], tps / tps[-1]))
+    thresholds = np.concatenate(([np.inf], thresholds))
+    return fpr, tpr, thresholds
+
+def evaluate(labels, scores, metric='roc', output_directory="./", epoch=0, saveto=False):
+    labels, scores = _to_numpy(labels, scores)
     if metric == 'roc':
-        return roc(labels, scores, output_directory=output_directory, epoch=epoch)
+        return roc(labels, scores, saveto=saveto, output_directory=output_directory, epoch=epoch)
     elif metric == 'auprc':
         return auprc(labels, scores)
     elif metric == 'f1_score':
         threshold = 0.20
-        scores[scores >= threshold] = 1
-        scores[scores <  threshold] = 0
-        return f1_score(labels, scores)
+        y_preds = np.empty(scores.shape, dtype=np.int8)
+        np.greater_equal(scores, threshold, out=y_preds)
+        return f1_score(labels, y_preds)
     else:
         raise NotImplementedError("Check the evaluation metric.")
 
 ##
-def roc(labels, scores, saveto=True, output_directory="./", epoch = 0):
-    """Compute ROC curve and ROC area for each class"""
-    fpr = dict()
-    tpr = dict()
-    roc_auc = dict()
-
-    labels = labels.cpu()
-    scores = scores.cpu()
-    #labels = labels - 1
-    #print(labels)
+def _plot_roc(fpr, tpr, roc_auc, eer, path):
+    """Draw the ROC curve with its EER point and save it to path."""
+    global _ROC_FIG, _ROC_AX
+    with PYPLOT_LOCK:
+        if _ROC_FIG is None:
+            _ROC_FIG, _ROC_AX = plt.subplots()
+        else:
+            _ROC_AX.cla()
+        lw = 2
+        _ROC_AX.plot(fpr, tpr, color='darkorange', lw=lw, label='(AUC = %0.2f, EER = %0.2f)' % (roc_auc, eer))
+        _ROC_AX.plot([eer], [1-eer], marker='o', markersize=5, color="navy")
+        _ROC_AX.plot([0, 1], [1, 0], color='navy', lw=1, linestyle=':')
+        _ROC_AX.set_xlim([0.0, 1.0])
+        _ROC_AX.set_ylim([0.0, 1.05])
+        _ROC_AX.set_xlabel('False Positive Rate')
+        _ROC_AX.set_ylabel('True Positive Rate')
+        _ROC_AX.set_title('Receiver operating characteristic')
+        _ROC_AX.legend(loc="lower right")
+        _ROC_FIG.savefig(path)
+
+##
+def roc(labels, scores, saveto=False, output_directory="./", epoch = 0):
+    """Compute ROC curve and ROC area for each class.
+
+    The curve is only plotted to output_directory when saveto is set, e.g.
+    every few epochs, so that per-epoch evaluation stays metric-only.
+    """
+    labels, scores = _to_numpy(labels, scores)
     # True/False Positive Rates.
-    fpr, tpr, t = roc_curve(labels, scores, pos_label=1)
+    fpr, tpr, t = _fast_roc(labels, scores)
     roc_auc = auc(fpr, tpr)
 
     #threshold
-    i = np.arange(len(tpr))
-    roc = pd.DataFrame({'tf': pd.Series(tpr - (1 - fpr), index=i), 'threshold': pd.Series(t, index=i)})
-    roc_t = roc.iloc[(roc.tf - 0).abs().argsort()[:1]]
-    threshold = roc_t['threshold']
-    threshold = list(threshold)[0]
-    #print(list(threshold))
-    # Equal Error Rate
-    eer = brentq(lambda x: 1. - x - interp1d(fpr, tpr)(x), 0., 1.)
+    threshold = t[np.argmin(np.abs(tpr - (1 - fpr)))]
+    # Equal Error Rate: the ROC polyline crosses tpr = 1 - fpr on segment [k-1, k].
+    k = np.searchsorted(tpr + fpr - 1., 0.)
+    x0, x1, y0, y1 = fpr[k - 1], fpr[k], tpr[k - 1], tpr[k]
+    eer = x0 + (1. - x0 - y0) / ((x1 - x0) + (y1 - y0)) * (x1 - x0)
 
     if saveto:
-        plt.figure()
-        lw = 2
-        plt.plot(fpr, tpr, color='darkorange', lw=lw, label='(AUC = %0.2f, EER = %0.2f)' % (roc_auc, eer))
-        plt.plot([eer], [1-eer], marker='o', markersize=5, color="navy")
-        plt.plot([0, 1], [1, 0], color='navy', lw=1, linestyle=':')
-        plt.xlim([0.0, 1.0])
-        plt.ylim([0.0, 1.05])
-        plt.xlabel('False Positive Rate')
-        plt.ylabel('True Positive Rate')
-        plt.title('Receiver operating characteristic')
-        plt.legend(loc="lower right")
-        plt.savefig(output_directory + "/ROC" + str(epoch) + ".png")
-        plt.close()
+        _plot_roc(fpr, tpr, roc_auc, eer, os.path.join(output_directory, "ROC" + str(epoch) + ".png"))
 
     return roc_auc, threshold, t
 
@@ -83,33 +132,72 @@ def auprc(labels, scores):
     ap = average_precision_score(labels, scores, pos_label=1)
     return ap
 
+def _is_uniform_grid(thresholds):
+    """True if thresholds are finite, strictly monotone and evenly spaced."""
+    if thresholds.size < 2 or not np.all(np.isfinite(thresholds)):
+        return False
+    steps = np.diff(thresholds)
+    # Strict monotonicity is what np.digitize needs; relative tolerance only so tiny steps are not waved through.
+    if not (np.all(steps > 0) or np.all(steps < 0)):
+        return False
+    return np.allclose(steps, steps[0], rtol=1e-5, atol=0)
+
+def _counts_on_uniform_grid(labels, scores, thresholds):
+    """tp/fp per threshold of an evenly spaced grid by bucketing the scores, no sort needed."""
+    ascending = thresholds[1] > thresholds[0]
+    grid = thresholds if ascending else thresholds[::-1]
+    # bins[i] = number of grid thresholds <= scores[i]
+    bins = np.digitize(scores, grid)
+    tp_per_bin = np.bincount(bins, weights=labels, minlength=grid.size + 1)
+    fp_per_bin = np.bincount(bins, weights=1 - labels, minlength=grid.size + 1)
+    # A sample counts as positive at grid[j] iff its bin is > j.
+    tp = np.cumsum(tp_per_bin[::-1])[::-1][1:]
+    fp = np.cumsum(fp_per_bin[::-1])[::-1][1:]
+    if not ascending:
+        tp, fp = tp[::-1], fp[::-1]
+    return tp, fp
+
 def get_values_for_pr_curve(y_trues, y_preds, thresholds):
-    precisions = []
-    recalls = []
-    tn_counts = []
-    fp_counts = []
-    fn_counts = []
-    tp_counts = []
-    for threshold in thresholds:
-        y_preds_new = [1 if ele >= threshold else 0 for ele in y_preds] 
-        tn, fp, fn, tp = confusion_matrix(y_trues, y_preds_new).ravel()
-        if len(set(y_preds_new)) == 1:
-            print("y_preds_new did only contain the element {}... Continuing with next iteration!".format(y_preds_new[0]))
-            continue
-        
-        precision, recall, _, _ = precision_recall_fscore_support(y_trues, y_preds_new, average="binary", pos_label=1)
-        precisions.append(precision)
-        recalls.append(recall)
-        tn_counts.append(tn)
-        fp_counts.append(fp)
-        fn_counts.append(fn)
-        tp_counts.append(tp)
-        
-        
-    
-    return np.array(tp_counts), np.array(fp_counts), np.array(tn_counts), np.array(fn_counts), np.array(precisions), np.array(recalls), len(thresholds)
+    """Confusion counts, precision and recall for every threshold.
+
+    The counts at every distinct score come from one sorted pass of
+    scikit-learn's confusion_matrix_at_thresholds; each requested threshold
+    is then looked up by binary search. Evenly spaced thresholds skip the
+    sort and bucket the scores directly. Thresholds for which all samples
+    end up in the same class are skipped.
+    """
+    y_trues, y_preds = _to_numpy(y_trues, y_preds)
+    # Compare in the scores' precision, as thresholding the float32 tensors did.
+    thresholds = np.asarray(thresholds, dtype=y_preds.dtype)
+    n_pos = np.count_nonzero(y_trues)
+    n_neg = y_trues.size - n_pos
+
+    if _is_uniform_grid(thresholds):
+        tp, fp = _counts_on_uniform_grid(y_trues, y_preds, thresholds)
+    else:
+        _, fps, _, tps, score_thresholds = confusion_matrix_at_thresholds(y_trues, y_preds)
+        # Leading zero: index k holds the counts of the k highest distinct scores.
+        tps = np.concatenate(([0], tps))
+        fps = np.concatenate(([0], fps))
+        idx = np.searchsorted(-score_thresholds, -thresholds, side='right')
+        tp = tps[idx]
+        fp = fps[idx]
+    fn = n_pos - tp
+    tn = n_neg - fp
+
+    n_pred_pos = tp + fp
+    keep = (n_pred_pos > 0) & (n_pred_pos < y_preds.size)
+    if not keep.all():
+        print("Skipped {} thresholds that predicted only a single class.".format(np.count_nonzero(~keep)))
+    tp, fp, tn, fn = tp[keep], fp[keep], tn[keep], fn[keep]
+
+    precisions = tp / (tp + fp)
+    recalls = np.divide(tp, n_pos, out=np.zeros(tp.shape), where=n_pos > 0)
+
+    return tp, fp, tn, fn, precisions, recalls, len(thresholds)
 
 def get_performance(y_trues, y_preds):
+    y_trues, y_preds = _to_numpy(y_trues, y_preds)
     fpr, tpr, t = roc_curve(y_trues, y_preds)
     roc_score = auc(fpr, tpr)
     ap = average_precision_score(y_trues, y_preds, pos_label=1)
@@ -117,13 +205,9 @@ def get_performance(y_trues, y_preds):
     precisions = [0.996, 0.99, 0.95, 0.9]
     temp_dict=dict()
     
-    for th in t:
-        y_preds_new = [1 if ele >= th else 0 for ele in y_preds] 
-        if len(set(y_preds_new)) == 1:
-            print("y_preds_new did only contain the element {}... Continuing with next iteration!".format(y_preds_new[0]))
-            continue
-        
-        precision, recall, _, _ = precision_recall_fscore_support(y_trues, y_preds_new, average="binary", pos_label=1)
+    # Precision/recall at every ROC threshold from one sorted pass.
+    _, _, _, _, th_precisions, th_recalls, _ = get_values_for_pr_curve(y_trues, y_preds, t)
+    for precision, recall in zip(th_precisions, th_recalls):
         temp_dict[str(precision)] = recall
     p_dict = OrderedDict(sorted(temp_dict.items(), reverse=True))
     for p in precisions:   
@@ -137,15 +221,11 @@ def get_performance(y_trues, y_preds):
     
     
     #Threshold
-    i = np.arange(len(tpr))
-    roc = pd.DataFrame({'tf': pd.Series(tpr - (1 - fpr), index=i), 'threshold': pd.Series(t, index=i)})
-    roc_t = roc.iloc[(roc.tf - 0).abs().argsort()[:1]]
-    threshold = roc_t['threshold']
-    threshold = list(threshold)[0]
+    threshold = t[np.argmin(np.abs(tpr - (1 - fpr)))]
     
     
     
-    y_preds = [1 if ele >= threshold else 0 for ele in y_preds] 
+    y_preds = (y_preds >= threshold).view(np.int8)
     
     
     precision, recall, f1_score, _ = precision_recall_fscore_support(y_trues, y_preds, average="binary", pos_label=1)
@@ -351,6 +351,8 @@ class Skipganomaly:
             if self.total_steps % self.opt.save_image_freq == 0:
                 self.visualizer.save_current_images(self.epoch, reals, fakes, fixed)
 
+        if self.opt.display:
+            self.visualizer.flush_scalars()
         print(">> Training model %s. Epoch %d/%d" % (self.name, self.epoch+1, self.opt.niter))
 
     ##
@@ -372,6 +374,7 @@ class Skipganomaly:
                 best_auc = res['auc']
                 self.save_weights(self.epoch, is_best=True)
             self.visualizer.print_current_performance(res, best_auc)
+        self.visualizer.wait_for_plots()
         print(">> Training model %s.[Done]" % self.name)
 
     ##
@@ -524,6 +527,7 @@ class Skipganomaly:
             self.visualizer.plot_performance(1, 0, performance, tag="Performance_Inference")
                 
             write_inference_result(file_names=self.file_names, y_trues=y_trues, y_preds=y_preds_after_threshold,outf=os.path.join(self.opt.outf, "classification_result.json"))
+            self.visualizer.wait_for_plots()
             ##
             # RETURN
             return performance
@@ -7,12 +7,15 @@ Returns:
 ##
 import os
 import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from matplotlib import pyplot as plt
 import numpy as np
 import pandas as pd
+import torch
 import torchvision.utils as vutils
 from .plot import plot_confusion_matrix
-from .evaluate import get_values_for_pr_curve
+from .evaluate import get_values_for_pr_curve, PYPLOT_LOCK
 import seaborn as sns
 
 ##
@@ -33,13 +36,27 @@ class Visualizer():
         # use tensorboard for now
         if self.opt.display:
             from tensorboardX import SummaryWriter
-            self.writer = SummaryWriter(log_dir=os.path.join("../tensorboard/skip_ganomaly/", opt.outf))
+            self.writer = SummaryWriter(log_dir=os.path.join("../tensorboard/skip_ganomaly/", opt.outf), flush_secs=120, max_queue=1000)
+        # Per-step scalars waiting for flush_scalars, keyed by tag.
+        self._scalar_buffer = defaultdict(list)
 
         # --
         # Dictionaries for plotting data and results.
         self.plot_data = None
         self.plot_res = None
 
+        # --
+        # Single worker that renders figures off the training thread.
+        # It holds PYPLOT_LOCK while drawing; other pyplot users take the lock
+        # or call wait_for_plots first.
+        self._plot_pool = ThreadPoolExecutor(max_workers=1)
+        self._plot_futures = []
+
+        # --
+        # Format template for print_current_errors and the loss keys it was built for.
+        self._err_keys = None
+        self._err_fmt = None
+
         # --
         # Path to train and test directories.
         self.img_dir = os.path.join(opt.outf, opt.name, 'train', 'images')
@@ -51,6 +68,8 @@ class Visualizer():
         # --
         # Log file.
         self.log_name = os.path.join(opt.outf, opt.name, 'loss_log.txt')
+        # Kept open for the lifetime of the visualizer; line-buffered so each message lands on disk.
+        self._log_fh = open(self.log_name, "a", buffering=1)
         # with open(self.log_name, "a") as log_file:
         #     now = time.strftime("%c")
         #     log_file.write('================ Training Loss (%s) ================\n' % now)
@@ -59,11 +78,16 @@ class Visualizer():
         info  = f'Anomalies, {opt.nz}, {opt.w_adv}, {opt.w_con}, {opt.w_lat}\n'
         self.write_to_log_file(text=title + info)
 
+    ##
+    def __del__(self):
+        log_fh = getattr(self, "_log_fh", None)
+        if log_fh is not None and not log_fh.closed:
+            log_fh.close()
 
     ##
     @staticmethod
     def normalize(inp):
-        """Normalize the tensor
+        """Normalize the tensor on its own device
 
         Args:
             inp ([FloatTensor]): Input tensor
@@ -71,7 +95,8 @@ class Visualizer():
         Returns:
             [FloatTensor]: Normalized tensor.
         """
-        return (inp - inp.min()) / (inp.max() - inp.min() + 1e-5)
+        inp_min = inp.amin()
+        return (inp - inp_min) / (inp.amax() - inp_min + 1e-5)
 
     ##
     def plot_current_errors(self, epoch, total_steps, errors):
@@ -82,8 +107,17 @@ class Visualizer():
             counter_ratio (float): Ratio to plot the range between two epoch.
             errors (OrderedDict): Error for the current epoch.
         """
-        self.writer.add_scalars("Loss over time", errors, global_step=total_steps)
-        
+        # Detach so buffered losses do not keep the autograd graph alive.
+        errors = {k: v.detach() if torch.is_tensor(v) else v for k, v in errors.items()}
+        self._scalar_buffer["Loss over time"].append((total_steps, errors))
+
+    ##
+    def flush_scalars(self):
+        """Write all buffered scalars to tensorboard in one batch."""
+        for tag, entries in self._scalar_buffer.items():
+            for step, scalars in entries:
+                self.writer.add_scalars(tag, {k: float(v) for k, v in scalars.items()}, global_step=step)
+        self._scalar_buffer.clear()
 
     ##
     def plot_performance(self, epoch, counter_ratio, performance, tag=None):
@@ -99,9 +133,28 @@ class Visualizer():
             
         
     def plot_current_conf_matrix(self, epoch, cm, tag=None):
-        plot = plot_confusion_matrix(cm, normalize=False, savefig=False)
-        self.writer.add_figure(tag if tag else "Confusion Matrix", plot, global_step=epoch)
-        
+        """ Render the confusion matrix on the plot worker and log it to tensorboard.
+
+        Args:
+            epoch (int): Current epoch
+            cm (np.ndarray): Confusion matrix, copied before handing it to the worker.
+            tag (str): Tensorboard tag.
+        """
+        cm = np.array(cm, copy=True)
+        self._plot_futures.append(self._plot_pool.submit(self._render_conf_matrix, epoch, cm, tag))
+
+    def _render_conf_matrix(self, epoch, cm, tag):
+        with PYPLOT_LOCK:
+            plot = plot_confusion_matrix(cm, normalize=False, savefig=False)
+            self.writer.add_figure(tag if tag else "Confusion Matrix", plot, global_step=epoch)
+
+    def wait_for_plots(self):
+        """ Block until queued figures are written; re-raises errors from the worker.
+        """
+        for future in self._plot_futures:
+            future.result()
+        self._plot_futures = []
+
 
     ##
     def print_current_errors(self, epoch, errors):
@@ -115,17 +168,19 @@ class Visualizer():
         """
         # message = '   [%d/%d] ' % (epoch, self.opt.niter)
         message = '   Loss: [%d/%d] ' % (epoch, self.opt.niter)
-        for key, val in errors.items():
-            message += '%s: %.3f ' % (key, val)
+        keys = tuple(errors.keys())
+        if keys != self._err_keys:
+            # Loss keys are fixed for a run, so this is built once.
+            self._err_keys = keys
+            self._err_fmt = ''.join('%s: {:.3f} ' % key.replace('{', '{{').replace('}', '}}') for key in keys)
+        message += self._err_fmt.format(*errors.values())
 
         print(message)
-        with open(self.log_name, "a") as log_file:
-            log_file.write('%s\n' % message)
+        self._log_fh.write('%s\n' % message)
 
     ##
     def write_to_log_file(self, text):
-        with open(self.log_name, "a") as log_file:
-            log_file.write('%s\n' % text)
+        self._log_fh.write('%s\n' % text)
 
     ##
     def print_current_performance(self, performance, best):
@@ -135,13 +190,10 @@ class Visualizer():
             performance ([OrderedDict]): Performance of the model
             best ([int]): Best performance.
         """
+        # Keys carry the measured precision and change every epoch, so no template is cached.
         message = '   '
-        #print(performance)
-        for key, val in performance.items():
-            if key == "conf_matrix":
-                message += '%s: %s ' % (key, val)
-            else:
-                message += '%s: %.3f ' % (key, val)
+        message += ''.join(f'{key}: {val} ' if key == "conf_matrix" else f'{key}: {val:.3f} '
+                           for key, val in performance.items())
         message += 'max AUC: %.3f' % best
 
         print(message)
@@ -157,8 +209,9 @@ class Visualizer():
             fakes ([FloatTensor]): Fake Image
             fixed ([FloatTensor]): Fixed Fake Image
         """
-        reals = self.normalize(reals.cpu().numpy())
-        fakes = self.normalize(fakes.cpu().numpy())
+        # Normalize on device; tensorboardX converts the tensors itself when serializing.
+        reals = self.normalize(reals.detach())
+        fakes = self.normalize(fakes.detach())
         # fixed = self.normalize(fixed.cpu().numpy())
         self.writer.add_images("Reals from {} step: ".format(str(train_or_test)), reals, global_step=global_step)
         self.writer.add_images("Fakes from {} step: ".format(str(train_or_test)), fakes, global_step=global_step)
@@ -182,6 +235,8 @@ class Visualizer():
         vutils.save_image(fixed, '%s/fixed_fakes_%03d.png' %(self.img_dir, epoch+1), normalize=True)
         
     def plot_histogram(self, y_trues, y_preds, threshold, global_step=1, save_path=None, tag=None):
+        # pyplot is not thread-safe; let the plot worker finish first.
+        self.wait_for_plots()
         scores = dict()
         scores["scores"] = y_preds
         scores["labels"] = y_trues